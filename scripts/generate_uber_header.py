@@ -7,39 +7,164 @@ This script generates both modular and uber header files for the C++ON library.
 import os
 import re
 import json
+import codecs
+import functools
+import stat
+import uuid
 
-def read_file(path):
-    """Read a file with multiple encoding fallbacks."""
-    encodings = ['utf-8', 'latin1', 'cp1252']
-    for encoding in encodings:
+# A tag also takes its trailing blanks, the line ending and ONE following blank
+# line, so that an empty replacement can drop its whole line. Patterns start with
+# the literal '[[' so the regex engine can search for it directly.
+_TAG_TRAIL = r'(?P<trail>[ \t]*(?:\r?\n)?(?:[ \t]*\r?\n)?)'
+# Conditional tags [[@COND ? then : else]], flagging @STDCAPTURE branches at match time
+_COND_RE = re.compile(r'\[\[@(?P<cond>[A-Z0-9_]+)\s*\?\s*'
+                      r'(?P<then>(?P<then_std>@STDCAPTURE)[^:]*|[^:]+)\s*:\s*'
+                      r'(?P<else>(?P<else_std>@STDCAPTURE)[^\]]*|[^\]]+)\]\]' + _TAG_TRAIL)
+# Simple inclusions [[FRAGMENT]]
+_FRAG_RE = re.compile(r'\[\[(?P<name>[A-Z0-9_]+)\]\]' + _TAG_TRAIL)
+
+# Quoted include targets recognised as headers
+_HEADER_EXTS = ('.h"', '.hpp"', '.hxx"', '.h++"')
+
+# Uber-pass fragment key of the #include block built from STANDARD_INCLUDES
+# ('#' is not allowed in tag names, so no [[...]] tag can reach it directly)
+_STD_INCLUDE_BLOCK = "#STANDARD_INCLUDES"
+
+# Header key -> template/include sub-directory (anything else lives in "cppon")
+_NAMESPACE = {
+    "PROCESSOR_FEATURES_INFO": "platform",
+    "SIMD_COMPARISONS": "simd",
+}
+
+@functools.lru_cache(maxsize=256)
+def _read_file_cached(abs_path):
+    """Read and decode a file once; later reads of the same path hit the cache."""
+    with open(abs_path, 'rb') as f:
+        data = f.read()
+    if data.startswith(codecs.BOM_UTF8):
+        text = data.decode('utf-8-sig')
+    elif data.isascii():
+        text = data.decode('ascii')
+    else:
         try:
-            with open(path, 'r', encoding=encoding) as f:
-                return f.read()
+            text = data.decode('utf-8')
         except UnicodeDecodeError:
-            continue
-    with open(path, 'r', encoding='latin1') as f:
-        return f.read()
+            try:
+                text = data.decode('cp1252')
+            except UnicodeDecodeError:
+                text = data.decode('latin1')
+    # Same newline handling as text mode (universal newlines)
+    return text.replace('\r\n', '\n').replace('\r', '\n')
+
+def read_file(path):
+    """Read a file with multiple encoding fallbacks."""
+    return _read_file_cached(os.path.abspath(path))
+
+# Output directories already created during this run
+_created_dirs = set()
 
 def write_file(path, content):
-    """Write content to a file, creating directories if needed."""
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    with open(path, 'w', encoding='utf-8') as f:
-        f.write(content)
-
-def _replace_tag(template_content, tag_text, replacement):
-    """Replace a tag; if replacement is empty/whitespace, drop the whole line (and one following blank line)."""
-    if replacement.strip() == "":
-        # Line containing the tag + optional line ending + ONE following blank line
-        pattern = r'^[ \t]*' + re.escape(tag_text) + r'[ \t]*(?:\r?\n)?(?:[ \t]*\r?\n)?'
-        return re.sub(pattern, '', template_content, flags=re.MULTILINE)
-    else:
-        return template_content.replace(tag_text, replacement)
+    """Write content to a file atomically, creating directories if needed."""
+    directory = os.path.dirname(path)
+    if directory not in _created_dirs:
+        os.makedirs(directory, exist_ok=True)
+        _created_dirs.add(directory)
+    # Same line endings as text mode, encoded up front and written in one go
+    if os.linesep != '\n':
+        content = content.replace('\n', os.linesep)
+    data = content.encode('utf-8')
+    # Unique temporary file next to the target (mode 0666 minus the umask, like
+    # open()), removed again if anything fails
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        # An existing header keeps its mode, as it did when rewritten in place
+        try:
+            os.chmod(tmp_path, stat.S_IMODE(os.stat(path).st_mode))
+        except FileNotFoundError:
+            pass
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def _canon(path):
+    """Canonical form of a path, so one file always maps to one key."""
+    return os.path.normcase(os.path.realpath(path))
+
+def _join_fragments(fragments):
+    """Join each fragment's lines once, so tags can be replaced by a plain lookup."""
+    return {name: '\n'.join(lines) if isinstance(lines, list) else lines
+            for name, lines in fragments.items()}
+
+def _std_includes_fragment(fragments, is_uber):
+    """#include block gathered by the modular pass (uber header only)."""
+    return fragments.get(_STD_INCLUDE_BLOCK, "") if is_uber else None
+
+def _assert_macro_fragment(fragments, is_uber):
+    """CPPON_ASSERT definition; expands to nothing if not configured."""
+    return fragments.get("ASSERT_MACRO", "")
+
+# Fragments with dedicated handling; a handler returning None defers to the generic lookup
+_SPECIAL_FRAGMENTS = {
+    "STANDARD_INCLUDES": _std_includes_fragment,
+    "ASSERT_MACRO": _assert_macro_fragment,
+}
+
+def _line_blank_after(text, line_blank):
+    """Whether the current output line holds only blanks once text is appended."""
+    newline = text.rfind('\n')
+    if newline >= 0:
+        return not text[newline + 1:].strip(' \t')
+    return line_blank and not text.strip(' \t')
+
+def _replace_tags(pattern, content, resolve):
+    """
+    Replace every tag matched by pattern with resolve(match), in a single pass.
+    An empty/whitespace replacement drops the whole line (and one following blank
+    line) when only blanks precede the tag on its line; elsewhere the tag is kept.
+    """
+    parts = []
+    pos = 0
+    line_blank = True
+    for match in pattern.finditer(content):
+        before = content[pos:match.start()]
+        line_blank = _line_blank_after(before, line_blank)
+        replacement = resolve(match)
+        if not replacement or replacement.isspace():
+            if line_blank:
+                # Cut the indent; the match already holds the rest of the line
+                parts.append(before.rstrip(' \t'))
+            else:
+                parts.append(before)
+                parts.append(match.group(0))
+                line_blank = _line_blank_after(match.group('trail'), False)
+        else:
+            trail = match.group('trail')
+            parts.append(before)
+            parts.append(replacement)
+            parts.append(trail)
+            line_blank = _line_blank_after(trail, _line_blank_after(replacement, line_blank))
+        pos = match.end()
+    parts.append(content[pos:])
+    return ''.join(parts)
 
 def _cleanup_content(content):
     """Minimal final cleanup: trim trailing spaces (leaves empty lines intact)."""
-    # Remove trailing spaces
-    content = re.sub(r'[ \t]+(\r?\n)', r'\1', content)
-    return content
+    # Remove trailing spaces (the last piece has no line ending and is kept as is)
+    lines = content.split('\n')
+    last = lines.pop()
+    if '\r' in content:
+        lines = [line[:-1].rstrip(' \t') + '\r' if line.endswith('\r') else line.rstrip(' \t') for line in lines]
+    else:
+        lines = [line.rstrip(' \t') for line in lines]
+    lines.append(last)
+    return '\n'.join(lines)
 
 def process_template(template_content, fragments, headers, is_uber, std_includes=None, base_path=None, processed_templates=None):
     """
@@ -48,89 +173,76 @@ def process_template(template_content, fragments, headers, is_uber, std_includes
     if processed_templates is None:
         processed_templates = set()
     
-    # Conditional tags [[@COND ? then : else]]
-    pattern = r'\[\[@([A-Z0-9_]+)\s*\?\s*([^:]+)\s*:\s*([^\]]+)\]\]'
-    for match in re.finditer(pattern, template_content):
-        full_tag = match.group(0)
-        condition, then_branch, else_branch = match.groups()
-        value = then_branch.strip() if condition == "UBER" and is_uber else else_branch.strip()
+    def _cond_repl(match):
+        condition, then_branch, else_branch = match.group('cond', 'then', 'else')
+        if condition == "UBER" and is_uber:
+            value, value_is_std = then_branch.strip(), match.group('then_std') is not None
+        else:
+            value, value_is_std = else_branch.strip(), match.group('else_std') is not None
 
-        if then_branch.strip().startswith('@STDCAPTURE') and std_includes is not None and not is_uber:
+        if match.group('then_std') is not None and std_includes is not None and not is_uber:
             include_match = re.search(r'<([^>]+)>', else_branch)
             if include_match:
                 std_includes.add(f"<{include_match.group(1)}>")
             replacement = f"#include {else_branch}"
-        elif value.startswith('@STDCAPTURE'):
+        elif value_is_std:
             replacement = ""
         elif value.startswith('@'):
             fragment_name = value[1:]
+            handler = _SPECIAL_FRAGMENTS.get(fragment_name)
+            special = handler(fragments, is_uber) if handler is not None else None
 
-            if fragment_name == "STANDARD_INCLUDES" and is_uber:
-                replacement = '\n'.join([f"#include {inc}" for inc in fragments.get("STANDARD_INCLUDES", [])])
-            elif fragment_name == "ASSERT_MACRO":
-                replacement = '\n'.join(fragments.get("ASSERT_MACRO", []))
+            if special is not None:
+                replacement = special
             elif fragment_name in fragments:
-                replacement = '\n'.join(fragments[fragment_name])
+                replacement = fragments[fragment_name]
             elif fragment_name in headers and base_path is not None and is_uber:
                 header_file = headers[fragment_name]
-                if fragment_name in ["PROCESSOR_FEATURES_INFO"]:
-                    namespace = "platform"
-                elif fragment_name in ["SIMD_COMPARISONS"]:
-                    namespace = "simd"
-                else:
-                    namespace = "cppon"
+                namespace = _NAMESPACE.get(fragment_name, "cppon")
                 template_path = os.path.join(base_path, "templates", "headers", namespace, header_file)
-                if template_path in processed_templates:
+                template_key = _canon(template_path)
+                if template_key in processed_templates:
                     replacement = f"/* Circular reference detected: {fragment_name} */"
                 else:
                     try:
-                        processed_templates.add(template_path)
+                        processed_templates.add(template_key)
                         template_content_inner = read_file(template_path)
-                        replacement = process_template(template_content_inner, fragments, headers, 
+                        replacement = process_template(template_content_inner, fragments, headers,
                                                        is_uber, std_includes, base_path, processed_templates)
                     except Exception as e:
                         replacement = f"/* Error processing {fragment_name}: {str(e)} */"
             else:
                 replacement = f"/* Fragment or header not found: {fragment_name} */"
         else:
-            header_extensions = ['.h"', '.hpp"', '.hxx"', '.h++"']
-            if not is_uber and ((value.startswith('"') and any(value.endswith(ext) for ext in header_extensions)) or 
+            if not is_uber and ((value.startswith('"') and value.endswith(_HEADER_EXTS)) or
                                 (value.startswith('<') and value.endswith('>'))):
                 replacement = f'#include {value}'
             else:
                 replacement = value.strip('\'"')
-        
-        template_content = _replace_tag(template_content, full_tag, replacement)
-    
+        return replacement
+
+    def _frag_repl(match):
+        return fragments.get(match.group('name'), "")
+
+    # Conditional tags [[@COND ? then : else]]
+    template_content = _replace_tags(_COND_RE, template_content, _cond_repl)
+
     # Simple inclusions [[FRAGMENT]]
-    pattern = r'\[\[([A-Z0-9_]+)\]\]'
-    for match in re.finditer(pattern, template_content):
-        full_tag = match.group(0)
-        fragment_name = match.group(1)
-        if fragment_name in fragments:
-            replacement = '\n'.join(fragments[fragment_name])
-        else:
-            replacement = ""
-        template_content = _replace_tag(template_content, full_tag, replacement)
-    
+    template_content = _replace_tags(_FRAG_RE, template_content, _frag_repl)
+
     # Final cleanup
     return _cleanup_content(template_content)
 
 def generate_modular_files(config, base_path):
     """Generate modular header files from templates."""
-    fragments = config['fragments']
+    fragments = _join_fragments(config['fragments'])
     headers = config['headers']
     std_includes = set()
     
     for key, template_name in headers.items():
         if key == "CPPON":
             continue
-        if key in ["PROCESSOR_FEATURES_INFO"]:
-            namespace = "platform"
-        elif key in ["SIMD_COMPARISONS"]:
-            namespace = "simd"
-        else:
-            namespace = "cppon"
+        namespace = _NAMESPACE.get(key, "cppon")
         output_name = template_name.replace('.tmpl', '.h')
         template_path = os.path.join(base_path, "templates", "headers", namespace, template_name)
         output_path = os.path.join(base_path, "include", namespace, output_name)
@@ -153,9 +265,11 @@ def generate_modular_files(config, base_path):
     return std_includes
 
 def generate_uber_file(config, base_path, std_includes):
-    fragments = config['fragments']
+    fragments = _join_fragments(config['fragments'])
     headers = config['headers']
-    fragments["STANDARD_INCLUDES"] = sorted(list(std_includes))
+    std_includes = sorted(std_includes)
+    fragments["STANDARD_INCLUDES"] = '\n'.join(std_includes)
+    fragments[_STD_INCLUDE_BLOCK] = '\n'.join(f"#include {inc}" for inc in std_includes)
     template_path = os.path.join(base_path, "templates", "headers", "c++on.tmpl")
     template_content = read_file(template_path)
     content = process_template(template_content, fragments, headers, 